@@ -1,30 +1,141 @@
 import os
+import sys
+import asyncio
 import logging
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
+from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
     CallbackQueryHandler,
+    BaseUpdateProcessor,
 )
-from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 import re
 
 # --- Configuration ---
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MONGO_URI = os.getenv("MONGO_URI")
-ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
+ADMIN_IDS = frozenset(int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id)
 LOG_CHANNEL_ID = int(os.getenv("LOG_CHANNEL_ID"))
 AUTO_FILTER_BOT_USERNAME = os.getenv("AUTO_FILTER_BOT_USERNAME")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # public base URL; unset = long polling
+PORT = int(os.getenv("PORT", "8443"))
+
+# Payment fields rendered in admin/user notifications
+NOTIFY_PROJECTION = {"user_id": 1, "username": 1, "txn_id": 1, "amount": 1}
+
+# Callback action -> resulting payment status
+DECISION_STATUSES = {"approve": "approved", "reject": "rejected"}
+
+# Only the update types the handlers below consume
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# username, 12-digit transaction id, amount; used as a handler filter,
+# which searches the raw text, hence the explicit anchors
+PAYMENT_RE = re.compile(r"\A\s*(\w+)\s+(\d{12})\s+(\d+)\s*\Z", re.ASCII)
+
+# --- Message Templates ---
+START_TEXT = (
+    "💰 Send your payment details:\n"
+    "Format: `username transaction_id amount`\n\n"
+    "Example: `john_doe 123456789012 50`"
+)
+INVALID_FORMAT_TEXT = (
+    "❌ Invalid format. Use:\n"
+    "`username 12digit_transaction_id amount`"
+)
+DUPLICATE_TEXT = "⚠️ This transaction was already submitted"
+RECEIVED_TEXT = "✅ Received! Admin will verify shortly."
+APPROVE_LABEL = "✅ Approve"
+REJECT_LABEL = "❌ Reject"
+
+SUBMISSION_TEMPLATE = (
+    "🆕 Payment Submission\n\n"
+    "👤 @{username} ({user_id})\n"
+    "💳 `{txn_id}`\n"
+    "💰 ₹{amount}\n"
+    "⏰ {date:%Y-%m-%d %H:%M} UTC"
+)
+USER_DECISION_TEMPLATES = {
+    "approved": (
+        "🔔 Payment approved!\n\n"
+        "Txn ID: `{txn_id}`\n"
+        "Amount: ₹{amount}\n\n"
+        "✅ Access will be activated soon"
+    ),
+    "rejected": (
+        "🔔 Payment rejected!\n\n"
+        "Txn ID: `{txn_id}`\n"
+        "Amount: ₹{amount}\n\n"
+        "❌ Contact admin for help"
+    ),
+}
+ADMIN_DECISION_LABELS = {
+    "approved": "✅ Approved by admin",
+    "rejected": "❌ Rejected by admin",
+}
+DECISION_LOG_TEMPLATE = (
+    "Payment {status}\n\n"
+    "User: @{username}\n"
+    "Txn: `{txn_id}`\n"
+    "Amount: ₹{amount}\n"
+    "Admin: {admin_id}"
+)
+ACTIVATION_TEMPLATE = "Run this command:\n/add_premium {user_id} 30days"
+
+def decision_keyboard(payment_id):
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(APPROVE_LABEL, callback_data=f"approve_{payment_id}"),
+        InlineKeyboardButton(REJECT_LABEL, callback_data=f"reject_{payment_id}")
+    ]])
 
 # --- Database Setup ---
-client = MongoClient(MONGO_URI)
-db = client[os.getenv("MONGO_DB_NAME", "moviehub")]
-payments = db["payments"]
+# Created in post_init so the client is bound to the running event loop
+# and nothing touches Mongo at import time
+client = None
+payments = None
+
+async def init_db(application: Application):
+    global client, payments
+    client = AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=50,  # headroom for concurrently processed updates
+        minPoolSize=10,  # kept warm so bursts after idle skip TCP/TLS/auth
+        serverSelectionTimeoutMS=2000,
+        connectTimeoutMS=2000,
+        socketTimeoutMS=5000,
+        compressors="zstd,zlib"
+    )
+    payments = client[os.getenv("MONGO_DB_NAME", "moviehub")]["payments"]
+    await payments.create_index("txn_id", unique=True, name="txn_id_unique")
+
+# Bounded, insertion-ordered set of recently submitted txn ids. Only a
+# shortcut for repeat submissions; the unique index stays authoritative.
+RECENT_TXN_LIMIT = 4096
+recent_txn_ids = OrderedDict()
+
+def remember_txn(txn_id):
+    recent_txn_ids[txn_id] = None
+    if len(recent_txn_ids) > RECENT_TXN_LIMIT:
+        recent_txn_ids.popitem(last=False)
+
+async def close_db(application: Application):
+    if client is not None:
+        await client.close()
 
 # --- Logging ---
 logging.basicConfig(
@@ -33,148 +144,277 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- Update Processing ---
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different chats concurrently while keeping
+    updates from the same chat in arrival order."""
+
+    def __init__(self, max_concurrent_updates: int):
+        # The base class acquires its semaphore before do_process_update,
+        # where an update may still wait for its chat's lock. Leave that one
+        # unbounded and enforce the real limit after the chat lock, so queued
+        # updates don't hold slots that other chats could use.
+        super().__init__(max_concurrent_updates=sys.maxsize)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or awaiting it]
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
 class PaymentBot:
     @staticmethod
     async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        await update.message.reply_text(
-            "💰 Send your payment details:\n"
-            "Format: `username transaction_id amount`\n\n"
-            "Example: `john_doe 123456789012 50`"
-        )
+        await update.message.reply_text(START_TEXT)
 
     @staticmethod
     async def handle_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        text = update.message.text.strip()
+        now = datetime.now(timezone.utc)
 
-        # Validate input
-        if not re.match(r"^\w+\s+\d{12}\s+\d+$", text):
-            await update.message.reply_text(
-                "❌ Invalid format. Use:\n"
-                "`username 12digit_transaction_id amount`"
-            )
+        # Format already validated by the PAYMENT_RE handler filter
+        username, txn_id, amount = context.match.groups()
+        
+        # Txn ids this process has already seen skip the Mongo round-trip
+        if txn_id in recent_txn_ids:
+            await update.message.reply_text(DUPLICATE_TEXT)
             return
 
-        username, txn_id, amount = text.split()
-        
-        # Check duplicate
-        if payments.find_one({"txn_id": txn_id}):
-            await update.message.reply_text("⚠️ This transaction was already submitted")
+        # Insert unless the txn id is already known, in one round-trip; the
+        # unique index rejects concurrent upserts of the same txn id
+        payment_id = ObjectId()
+        try:
+            existing = await payments.find_one_and_update(
+                {"txn_id": txn_id},
+                {"$setOnInsert": {
+                    "_id": payment_id,
+                    "user_id": user.id,
+                    "username": username,
+                    "amount": int(amount),
+                    "status": "pending",
+                    "date": now
+                }},
+                projection={"_id": 1},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            existing = True
+        remember_txn(txn_id)
+        if existing:
+            await update.message.reply_text(DUPLICATE_TEXT)
             return
+        payment_id = str(payment_id)
 
-        # Save payment
-        payment_id = payments.insert_one({
-            "user_id": user.id,
-            "username": username,
-            "txn_id": txn_id,
-            "amount": int(amount),
-            "status": "pending",
-            "date": datetime.now()
-        }).inserted_id
-
-        # User confirmation
-        await update.message.reply_text("✅ Received! Admin will verify shortly.")
-
-        # Admin approval buttons
-        keyboard = InlineKeyboardMarkup([[
-            InlineKeyboardButton("✅ Approve", callback_data=f"approve_{payment_id}"),
-            InlineKeyboardButton("❌ Reject", callback_data=f"reject_{payment_id}")
-        ]])
-
-        await context.bot.send_message(
-            chat_id=LOG_CHANNEL_ID,
-            text=(
-                f"🆕 Payment Submission\n\n"
-                f"👤 @{username} ({user.id})\n"
-                f"💳 `{txn_id}`\n"
-                f"💰 ₹{amount}\n"
-                f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+        # The admin submission is posted in the background: log channel
+        # sends wait on the per-group rate limit, and must not hold this
+        # update's processing slot while they do
+        context.application.create_task(
+            PaymentBot.post_submission(
+                context.bot,
+                SUBMISSION_TEMPLATE.format(
+                    username=escape_markdown(username),
+                    user_id=user.id,
+                    txn_id=txn_id,
+                    amount=amount,
+                    date=now
+                ),
+                payment_id
             ),
-            reply_markup=keyboard,
-            parse_mode="Markdown"
+            update=update
         )
+        await update.message.reply_text(RECEIVED_TEXT)
+
+    @staticmethod
+    async def post_submission(bot, text, payment_id):
+        try:
+            await bot.send_message(
+                chat_id=LOG_CHANNEL_ID,
+                text=text,
+                reply_markup=decision_keyboard(payment_id),
+                parse_mode="Markdown"
+            )
+        except Exception as e:
+            logger.error("Failed to send submission %s: %s", payment_id, e)
+
+    @staticmethod
+    async def invalid_format(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.message.reply_text(INVALID_FORMAT_TEXT)
 
     @staticmethod
     async def handle_decision(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
-        await query.answer()
+        admin_id = query.from_user.id
+
+        # Rejected clicks get an alert; the channel message stays intact
+        if admin_id not in ADMIN_IDS:
+            await query.answer("❌ Access denied", show_alert=True)
+            return
 
-        # Verify admin
-        if query.from_user.id not in ADMIN_IDS:
-            await query.edit_message_text("❌ Access denied")
+        action, _, payment_id = query.data.partition("_")
+        try:
+            payment_id = ObjectId(payment_id)
+        except InvalidId:
+            await query.answer("⚠️ Payment not found", show_alert=True)
             return
 
-        action, payment_id = query.data.split("_")
-        payment = payments.find_one({"_id": payment_id})
+        # Update status only if still pending: one atomic round-trip that
+        # also stops two admins from deciding the same payment
+        new_status = DECISION_STATUSES[action]
+        try:
+            payment = await payments.find_one_and_update(
+                {"_id": payment_id, "status": "pending"},
+                {"$set": {
+                    "status": new_status,
+                    "processed_by": admin_id,
+                    "processed_at": datetime.now(timezone.utc)
+                }},
+                projection=NOTIFY_PROJECTION,
+                return_document=ReturnDocument.BEFORE
+            )
+        except Exception:
+            # Don't leave the admin's button spinning on a Mongo timeout
+            await query.answer("⚠️ Try again", show_alert=True)
+            raise
 
         if not payment:
-            await query.edit_message_text("⚠️ Payment not found")
+            await query.answer("⚠️ Payment not found or already processed", show_alert=True)
             return
 
-        # Update status
-        new_status = "approved" if action == "approve" else "rejected"
-        payments.update_one(
-            {"_id": payment_id},
-            {"$set": {
-                "status": new_status,
-                "processed_by": query.from_user.id,
-                "processed_at": datetime.now()
-            }}
+        # Notifications run in the background so the callback returns
+        # as soon as the status is persisted
+        context.application.create_task(
+            PaymentBot.notify_decision(context.bot, payment, new_status, admin_id),
+            update=update
         )
 
-        # Notify user
-        await context.bot.send_message(
-            chat_id=payment["user_id"],
-            text=(
-                f"🔔 Payment {new_status}!\n\n"
-                f"Txn ID: `{payment['txn_id']}`\n"
-                f"Amount: ₹{payment['amount']}\n\n"
-                f"{'✅ Access will be activated soon' if new_status == 'approved' else '❌ Contact admin for help'}"
-            ),
-            parse_mode="Markdown"
+        # Clear the spinner and update the admin message concurrently
+        await asyncio.gather(
+            query.answer(),
+            query.edit_message_text(
+                f"{query.message.text}\n\n{ADMIN_DECISION_LABELS[new_status]}"
+            )
         )
 
-        # Update admin message
-        await query.edit_message_text(
-            f"{query.message.text}\n\n"
-            f"{'✅ Approved' if new_status == 'approved' else '❌ Rejected'} by admin",
-            parse_mode="Markdown"
-        )
+    @staticmethod
+    async def handle_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+        logger.error("Error while handling update %s", update, exc_info=context.error)
 
-        # Log to channel
-        await context.bot.send_message(
-            chat_id=LOG_CHANNEL_ID,
-            text=(
-                f"Payment {new_status}\n\n"
-                f"User: @{payment['username']}\n"
-                f"Txn: `{payment['txn_id']}`\n"
-                f"Amount: ₹{payment['amount']}\n"
-                f"Admin: {query.from_user.id}"
+    @staticmethod
+    async def notify_decision(bot, payment, new_status, admin_id):
+        sends = [
+            # Notify user
+            bot.send_message(
+                chat_id=payment["user_id"],
+                text=USER_DECISION_TEMPLATES[new_status].format_map(payment),
+                parse_mode="Markdown"
             ),
-            parse_mode="Markdown"
-        )
+            # Log to channel
+            bot.send_message(
+                chat_id=LOG_CHANNEL_ID,
+                text=DECISION_LOG_TEMPLATE.format(
+                    status=new_status,
+                    username=escape_markdown(payment["username"]),
+                    txn_id=payment["txn_id"],
+                    amount=payment["amount"],
+                    admin_id=admin_id
+                ),
+                parse_mode="Markdown"
+            ),
+        ]
 
         # If approved, send activation command
         if new_status == "approved":
-            await context.bot.send_message(
+            sends.append(bot.send_message(
                 chat_id=LOG_CHANNEL_ID,
-                text=f"Run this command:\n/add_premium {payment['user_id']} 30days",
-                parse_mode="Markdown"
-            )
+                text=ACTIVATION_TEMPLATE.format_map(payment)
+            ))
+
+        # The messages don't depend on each other, so send them concurrently
+        user_result, *channel_results = await asyncio.gather(*sends, return_exceptions=True)
+        if isinstance(user_result, (Forbidden, BadRequest)):
+            # e.g. the user blocked the bot; retrying won't help
+            logger.warning("Could not notify user %s: %s", payment["user_id"], user_result)
+        elif isinstance(user_result, Exception):
+            logger.error("Failed to notify user %s: %s", payment["user_id"], user_result)
+        for result in channel_results:
+            if isinstance(result, Exception):
+                logger.error("Failed to send decision to log channel: %s", result)
 
 def main():
-    app = Application.builder().token(BOT_TOKEN).build()
+    # Outgoing API calls share one pooled HTTP/2 connection; getUpdates
+    # keeps its own default request so long polls don't hold a slot
+    request = HTTPXRequest(
+        connection_pool_size=50,
+        http_version="2",
+        read_timeout=10,
+        write_timeout=10,
+        pool_timeout=1.0
+    )
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        # Telegram allows ~30 msg/s per bot and 20 msg/min per group or
+        # channel. The group bucket covers every LOG_CHANNEL_ID call: one per
+        # submission, three per approval (edit, log, activation command), two
+        # per rejection.
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=1
+        ))
+        .concurrent_updates(ChatOrderedUpdateProcessor(max_concurrent_updates=64))
+        .post_init(init_db)
+        .post_shutdown(close_db)
+        .build()
+    )
     
     # Handlers
     app.add_handler(CommandHandler("start", PaymentBot.start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, PaymentBot.handle_payment))
-    app.add_handler(CallbackQueryHandler(PaymentBot.handle_decision, pattern=r"^(approve|reject)_"))
+    app.add_handler(MessageHandler(filters.Regex(PAYMENT_RE), PaymentBot.handle_payment))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, PaymentBot.invalid_format))
+    app.add_handler(CallbackQueryHandler(
+        PaymentBot.handle_decision, pattern=r"^(approve|reject)_", block=False
+    ))
     
     # Error handling
-    app.add_error_handler(lambda u, c: logger.error(c.error) if c.error else None)
+    app.add_error_handler(PaymentBot.handle_error)
     
     logger.info("Payment bot started")
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=40
+        )
+    else:
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()